@@ -13,9 +13,11 @@ setup(
     install_requires=[
         "singer-python>=5.1.1",
         "pendulum",
+        "ciso8601",
         "ratelimit",
         "backoff",
         "requests",
+        "orjson",
     ],
     entry_points="""
     [console_scripts]
@@ -3,8 +3,11 @@
 import os
 import sys
 import json
+import math
 
+import orjson
 import singer
+import singer.messages
 from singer import utils
 from singer.catalog import Catalog, CatalogEntry, Schema
 from . import streams
@@ -66,8 +69,36 @@ def sync(ctx):
     streams.sync_selected_streams(ctx)
     ctx.write_state()
 
+SINGER_WRITE_MESSAGE = singer.messages.write_message
+
+def has_non_finite_float(obj):
+    if isinstance(obj, float):
+        return not math.isfinite(obj)
+    if isinstance(obj, dict):
+        return any(has_non_finite_float(value) for value in obj.values())
+    if isinstance(obj, list):
+        return any(has_non_finite_float(value) for value in obj)
+    return False
+
+def write_message(message, **kwargs):
+    message_dict = message.asdict()
+    # singer rejects NaN and infinity, at any depth, where orjson would write null
+    if has_non_finite_float(message_dict):
+        return SINGER_WRITE_MESSAGE(message, **kwargs)
+    try:
+        data = orjson.dumps(message_dict, option=orjson.OPT_APPEND_NEWLINE)
+    except TypeError:
+        # orjson can't encode Decimals, singer's encoder keeps their precision
+        return SINGER_WRITE_MESSAGE(message, **kwargs)
+    # written as UTF-8 bytes, so non-ASCII characters are not escaped and the
+    # output doesn't depend on stdout's encoding
+    sys.stdout.buffer.write(data)
+    sys.stdout.buffer.flush()
+
 @utils.handle_top_exception(LOGGER)
 def main():
+    # every record is serialized on the way out, orjson is much faster at it
+    singer.messages.write_message = write_message
     args = utils.parse_args(REQUIRED_CONFIG_KEYS)
     ctx = Context(args.config, args.state)
     if args.discover:
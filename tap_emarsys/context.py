@@ -1,8 +1,7 @@
 from datetime import datetime, date
 
-import pendulum
 import singer
-from singer import bookmarks as bks_, metadata
+from singer import bookmarks as bks_, metadata, utils
 
 from .http import Client
 
@@ -15,6 +14,8 @@ class Context(object):
     - client  - An HTTP client object for interacting with the API
     - catalog - A singer.catalog.Catalog. Note this will be None during
                 discovery.
+    - contacts_raw_fields - The contact fields from the API, fetched once and
+                            shared by discovery and the contacts sync
     """
     def __init__(self, config, state):
         self.config = config
@@ -22,6 +23,7 @@ class Context(object):
         self.client = Client(config)
         self._catalog = None
         self.selected_stream_ids = None
+        self.contacts_raw_fields = None
         self.now = datetime.utcnow()
 
     @property
@@ -61,7 +63,7 @@ class Context(object):
         if not val:
             val = self.config["start_date"]
             self.set_bookmark(path, val)
-        return pendulum.parse(val)
+        return utils.strptime_to_utc(val)
 
     def write_state(self):
         singer.write_state(self.state)
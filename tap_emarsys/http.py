@@ -1,18 +1,22 @@
 import os
 import hashlib
 import json
+import threading
 import time
 from datetime import datetime
 from binascii import hexlify
 from base64 import b64encode
 
 import requests
+from requests.adapters import HTTPAdapter
 import backoff
 import singer
 from singer import metrics
 
 LOGGER = singer.get_logger()
 
+POOL_SIZE = 20
+
 class RateLimitException(Exception):
     pass
 
@@ -25,11 +29,16 @@ class Client(object):
     def __init__(self, config):
         self.user_agent = config.get('user_agent')
         self.session = requests.Session()
+        # keep connections alive between calls, sized for the sync worker threads
+        adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+        self.session.mount('https://', adapter)
         self.username = config.get('username')
         self.secret = config.get('secret')
 
         self.calls_remaining = None
         self.limit_reset = None
+        # the client is shared by the sync worker threads
+        self.rate_limit_lock = threading.Lock()
 
     def get_wsse_header(self):
         nonce = hexlify(os.urandom(16)).decode('utf-8')
@@ -52,8 +61,11 @@ class Client(object):
                           max_tries=10,
                           factor=2)
     def request(self, method, path, **kwargs):
-        if self.calls_remaining is not None and self.calls_remaining == 0:
-            wait = self.limit_reset - int(time.monotonic())
+        with self.rate_limit_lock:
+            calls_remaining = self.calls_remaining
+            limit_reset = self.limit_reset
+        if calls_remaining is not None and calls_remaining == 0:
+            wait = limit_reset - int(time.monotonic())
             if wait > 0 and wait <= 300:
                 time.sleep(wait)
 
@@ -69,13 +81,14 @@ class Client(object):
             endpoint = kwargs['endpoint']
             del kwargs['endpoint']
             with metrics.http_request_timer(endpoint) as timer:
-                response = requests.request(method, self.url(path), **kwargs)
+                response = self.session.request(method, self.url(path), **kwargs)
                 timer.tags[metrics.Tag.http_status_code] = response.status_code
         else:
-            response = requests.request(method, self.url(path), **kwargs)
+            response = self.session.request(method, self.url(path), **kwargs)
 
-        self.calls_remaining = int(response.headers['X-Ratelimit-Remaining'])
-        self.limit_reset = int(response.headers['X-Ratelimit-Reset'])
+        with self.rate_limit_lock:
+            self.calls_remaining = int(response.headers['X-Ratelimit-Remaining'])
+            self.limit_reset = int(response.headers['X-Ratelimit-Reset'])
 
         if response.status_code in [429, 503]:
             raise RateLimitException()
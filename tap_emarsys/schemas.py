@@ -75,7 +75,11 @@ def get_contact_json_schema(raw_field_type):
     }
 
 def get_contacts_raw_fields(ctx):
-    return ctx.client.get('/field', endpoint='contact_fields')
+    # fields are needed for discovery, the contacts schema and the sync, so
+    # they're only fetched once per run
+    if ctx.contacts_raw_fields is None:
+        ctx.contacts_raw_fields = ctx.client.get('/field', endpoint='contact_fields')
+    return ctx.contacts_raw_fields
 
 def get_contacts_schema(ctx):
     raw_fields = get_contacts_raw_fields(ctx)
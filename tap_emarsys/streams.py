@@ -1,12 +1,18 @@
+import threading
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
 from functools import partial
+from operator import itemgetter
 
+import ciso8601
 import pendulum
 import singer
 from singer import metadata
 from singer.bookmarks import write_bookmark, reset_stream
 from ratelimit import limits, sleep_and_retry, RateLimitException
-from backoff import on_exception, expo, constant
+from backoff import on_exception, on_predicate, expo, constant
 
 from .schemas import (
     IDS,
@@ -19,27 +25,58 @@ from .http import MetricsRateLimitException
 LOGGER = singer.get_logger()
 
 MAX_METRIC_JOB_TIME = 1800
-METRIC_JOB_POLL_SLEEP = 5
-
-def count(tap_stream_id, records):
-    with singer.metrics.record_counter(tap_stream_id) as counter:
-        counter.increment(len(records))
+METRIC_JOB_POLL_INITIAL_SLEEP = 0.5
+METRIC_JOB_POLL_MAX_SLEEP = 30
+# /contact/query/ only supports offset pagination, so ids are paged in large
+# batches to keep the number of offset scans down, then fetched from
+# /contact/getdata in smaller batches
+CONTACTS_PAGE_SIZE = 10000
+CONTACTS_GETDATA_SIZE = 1000
+CONTACT_LIST_MEMBERSHIP_WORKERS = 4
+METRIC_JOB_WORKERS = 5
+ONE_DAY = timedelta(days=1)
+
+get_id = itemgetter('id')
+
+# records may be written from worker threads, this keeps messages whole
+WRITE_LOCK = threading.Lock()
 
 def write_records(tap_stream_id, records):
-    singer.write_records(tap_stream_id, records)
-    count(tap_stream_id, records)
+    # records may be any iterable, so they can be transformed as they're written
+    with WRITE_LOCK, singer.metrics.record_counter(tap_stream_id) as counter:
+        for record in records:
+            singer.write_record(tap_stream_id, record)
+            counter.increment()
 
 def get_date_and_integer_fields(stream):
-    date_fields = []
-    integer_fields = []
+    date_fields = set()
+    integer_fields = set()
     for prop, json_schema in stream.schema.properties.items():
         _type = json_schema.type
         if isinstance(_type, list) and 'integer' in _type or \
            _type == 'integer':
-           integer_fields.append(prop)
+           integer_fields.add(prop)
         elif json_schema.format == 'date-time':
-            date_fields.append(prop)
-    return date_fields, integer_fields
+            date_fields.add(prop)
+    return frozenset(date_fields), frozenset(integer_fields)
+
+def transform_date_time(value):
+    try:
+        date_time = ciso8601.parse_datetime(value)
+    except ValueError:
+        # not ISO 8601, fall back to the slower but more lenient parser
+        return pendulum.parse(value).isoformat()
+    if date_time.tzinfo is None:
+        date_time = date_time.replace(tzinfo=timezone.utc)
+    return date_time.isoformat()
+
+def parse_date(value):
+    if value == 'now':
+        return datetime.now(timezone.utc).date()
+    try:
+        return ciso8601.parse_datetime(value).date()
+    except ValueError:
+        return pendulum.parse(value).date()
 
 def base_transform(date_fields, integer_fields, obj):
     new_obj = {}
@@ -49,7 +86,7 @@ def base_transform(date_fields, integer_fields, obj):
         elif field in integer_fields and value is not None:
             value = int(value)
         elif field in date_fields and value is not None:
-            value = pendulum.parse(value).isoformat()
+            value = transform_date_time(value)
         new_obj[field] = value
     return new_obj
 
@@ -71,32 +108,38 @@ def sync_campaigns(ctx, sync):
     stream = ctx.catalog.get_stream('campaigns')
     date_fields, integer_fields = get_date_and_integer_fields(stream)
 
-    data_transformed = list(map(partial(base_transform, date_fields, integer_fields), data))
+    data_transformed = [base_transform(date_fields, integer_fields, obj) for obj in data]
 
     if sync:
         mdata = metadata.to_map(stream.metadata)
-        data_selected = list(map(partial(select_fields, mdata), data_transformed))
+        data_selected = [select_fields(mdata, obj) for obj in data_transformed]
         write_records('campaigns', data_selected)
     return data_transformed
 
-def transform_contact(field_id_map, contact):
+def get_contact_transform_plan(field_id_map):
+    return {
+        field_id: (field_info['name'], field_info['type'])
+        for field_id, field_info in field_id_map.items()
+    }
+
+def transform_contact(transform_plan, contact):
     new_obj = {}
     for field_id, value in contact.items():
-        if field_id in ['id', 'uid']:
+        if field_id == 'id' or field_id == 'uid':
             new_obj[field_id] = value
             continue
-        field_info = field_id_map[field_id]
+        field_name, field_type = transform_plan[field_id]
         if value == '' or value is None:
             value = None
-        elif field_info['type'] == 'date':
-            value = pendulum.parse(value).isoformat()
-        elif field_info['type'] == 'numeric':
+        elif field_type == 'date':
+            value = transform_date_time(value)
+        elif field_type == 'numeric':
             value = float(value)
-        new_obj[field_info['name']] = value
+        new_obj[field_name] = value
     return new_obj
 
-def sync_contacts_page(ctx, field_id_map, selected_fields, limit, offset):
-    LOGGER.info('contacts - Syncing page - limit: {}, offset: {}'.format(limit, offset))
+def get_contact_ids_page(ctx, limit, offset):
+    LOGGER.info('contacts - Fetching page - limit: {}, offset: {}'.format(limit, offset))
 
     contact_list_page = ctx.client.get(
         '/contact/query/',
@@ -110,25 +153,23 @@ def sync_contacts_page(ctx, field_id_map, selected_fields, limit, offset):
     if contact_list_page['errors']:
         raise Exception('contacts - {}'.format(','.join(contact_list_page['errors'])))
 
-    query = {
-        'keyId': 'id',
-        'keyValues': list(map(lambda x: x['id'], contact_list_page['result'])),
-        'fields': selected_fields
-    }
-    contact_page = ctx.client.post('/contact/getdata', query, endpoint='contacts')
+    return list(map(get_id, contact_list_page['result']))
 
-    contacts = list(map(partial(transform_contact, field_id_map), contact_page['result']))
-    write_records('contacts', contacts)
+def sync_contacts_page(ctx, transform_plan, selected_fields, contact_ids):
+    for i in range(0, len(contact_ids), CONTACTS_GETDATA_SIZE):
+        query = {
+            'keyId': 'id',
+            'keyValues': contact_ids[i:i + CONTACTS_GETDATA_SIZE],
+            'fields': selected_fields
+        }
+        contact_page = ctx.client.post('/contact/getdata', query, endpoint='contacts')
 
-    return len(contact_page['result'])
+        write_records('contacts', map(partial(transform_contact, transform_plan),
+                                      contact_page['result']))
+        # release this batch before the next response is parsed
+        del contact_page
 
-def sync_contacts(ctx):
-    contacts_stream = ctx.catalog.get_stream('contacts')
-    max_pages = ctx.config.get('max_pages')
-    if max_pages:
-        max_pages = int(max_pages)
-
-    raw_fields = get_contacts_raw_fields(ctx)
+def get_contact_field_maps(raw_fields):
     field_name_map = {}
     field_id_map = {}
     for raw_field in raw_fields:
@@ -141,6 +182,15 @@ def sync_contacts(ctx):
         }
         field_name_map[field_name] = field_info
         field_id_map[field_id] = field_info
+    return field_name_map, field_id_map
+
+def sync_contacts(ctx):
+    contacts_stream = ctx.catalog.get_stream('contacts')
+    max_pages = ctx.config.get('max_pages')
+    if max_pages:
+        max_pages = int(max_pages)
+
+    field_name_map, field_id_map = get_contact_field_maps(get_contacts_raw_fields(ctx))
     raw_fields_available = list(field_name_map.keys())
 
     selected_field_maps = []
@@ -160,26 +210,45 @@ def sync_contacts(ctx):
     if not selected_field_maps:
         selected_fields = ['3'] # no selected fields fetches all
     else:
-        selected_fields = list(map(lambda x: x['id'], selected_field_maps))
+        selected_fields = list(map(get_id, selected_field_maps))
+
+    transform_plan = get_contact_transform_plan(field_id_map)
 
-    limit = 1000
-    count = limit
-    offset = 0
-    while count == limit and \
-          (max_pages is None or (offset / limit) <= max_pages):
-        count = sync_contacts_page(ctx, field_id_map, selected_fields, limit, offset)
-        offset += limit
+    # max_pages has always counted pages of 1000 contacts, so that page size
+    # is kept by default when it's set
+    if max_pages is None:
+        default_limit = CONTACTS_PAGE_SIZE
+    else:
+        default_limit = CONTACTS_GETDATA_SIZE
+    limit = int(ctx.config.get('contacts_page_size', default_limit))
+    if not 1 <= limit <= CONTACTS_PAGE_SIZE:
+        raise Exception('contacts_page_size must be between 1 and {}, got {}'.format(
+            CONTACTS_PAGE_SIZE,
+            limit))
+    page = 0
+    # the next page of ids is fetched in the background while the current
+    # page's data is fetched and written, records are only written from here
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        next_ids = executor.submit(get_contact_ids_page, ctx, limit, 0)
+        while next_ids is not None:
+            contact_ids = next_ids.result()
+            page += 1
+            if len(contact_ids) == limit and (max_pages is None or page <= max_pages):
+                next_ids = executor.submit(get_contact_ids_page, ctx, limit, page * limit)
+            else:
+                next_ids = None
+            sync_contacts_page(ctx, transform_plan, selected_fields, contact_ids)
 
 def sync_contact_lists(ctx, sync):
     data = ctx.client.get('/contactlist', endpoint='contact_lists')
 
     stream = ctx.catalog.get_stream('contact_lists')
     date_fields, integer_fields = get_date_and_integer_fields(stream)
-    data_transformed = list(map(partial(base_transform, date_fields, integer_fields), data))
+    data_transformed = [base_transform(date_fields, integer_fields, obj) for obj in data]
 
     if sync:
         mdata = metadata.to_map(stream.metadata)
-        data_selected = list(map(partial(select_fields, mdata), data_transformed))
+        data_selected = [select_fields(mdata, obj) for obj in data_transformed]
         write_records('contact_lists', data_selected)
     return data_transformed
 
@@ -195,15 +264,17 @@ def sync_contact_list_memberships(ctx, contact_list_id, limit, offset):
                                         'offset': offset
                                     },
                                     endpoint='contact_list_memberships')
-    memberships = []
-    for membership_id in membership_ids:
-        memberships.append({
+    # pages can hold a million ids and several lists are synced at once, so
+    # records are generated as they're written instead of built up front
+    write_records('contact_list_memberships', (
+        {
             'contact_list_id': contact_list_id,
             'contact_id': membership_id
-        })
-    write_records('contact_list_memberships', memberships)
+        }
+        for membership_id in membership_ids
+    ))
 
-    return len(memberships)
+    return len(membership_ids)
 
 def sync_contact_lists_memberships(ctx, contact_lists):
     max_pages = ctx.config.get('max_pages')
@@ -213,14 +284,18 @@ def sync_contact_lists_memberships(ctx, contact_lists):
     if max_pages:
         contact_lists = contact_lists[:max_pages]
 
-    for contact_list in contact_lists:
+    def sync_contact_list(contact_list):
         limit = 1000000
         count = limit
-        offset = 0
-        while count == limit and \
-              (max_pages is None or (offset / limit) <= max_pages):
-            count = sync_contact_list_memberships(ctx, contact_list['id'], limit, offset)
-            offset += limit
+        page = 0
+        while count == limit and (max_pages is None or page <= max_pages):
+            count = sync_contact_list_memberships(ctx, contact_list['id'], limit, page * limit)
+            page += 1
+
+    # lists are independent, so several are requested at once
+    with ThreadPoolExecutor(max_workers=CONTACT_LIST_MEMBERSHIP_WORKERS) as executor:
+        # consume the results so worker exceptions are raised here
+        list(executor.map(sync_contact_list, contact_lists))
 
 @on_exception(constant, MetricsRateLimitException, max_tries=5, interval=60)
 @on_exception(expo, RateLimitException, max_tries=5)
@@ -242,48 +317,71 @@ def post_metric(ctx, metric, start_date, end_date, campaign_id):
         },
         endpoint='metrics_job')
 
-def sync_metric(ctx, campaign_id, metric, start_date, end_date):
+@on_predicate(expo,
+              lambda data: data == '',
+              max_time=MAX_METRIC_JOB_TIME,
+              factor=METRIC_JOB_POLL_INITIAL_SLEEP,
+              max_value=METRIC_JOB_POLL_MAX_SLEEP)
+def fetch_metric_job_result(ctx, job_id):
+    LOGGER.info('Polling metrics query job - {}'.format(job_id))
+    return ctx.client.get('/email/{}/responses'.format(job_id), endpoint='metrics')
+
+def submit_metric_job(ctx, campaign_id, metric, metric_date):
+    job = post_metric(ctx,
+                      metric,
+                      metric_date.isoformat(),
+                      (metric_date + ONE_DAY).isoformat(),
+                      campaign_id)
+    LOGGER.info('Metrics query job - {}'.format(job['id']))
+    return job['id']
+
+def sync_metric_job(ctx, campaign_id, metric, metric_date, job_id):
     with singer.metrics.job_timer('daily_aggregated_metric'):
-        job = post_metric(ctx,
-                          metric,
-                          start_date.to_date_string(),
-                          end_date.to_date_string(),
-                          campaign_id)
-
-        LOGGER.info('Metrics query job - {}'.format(job['id']))
-
         start = time.monotonic()
-        while True:
-            if (time.monotonic() - start) >= MAX_METRIC_JOB_TIME:
-                raise Exception('Metric job timeout ({} secs)'.format(
-                    MAX_METRIC_JOB_TIME))
-            LOGGER.info('Polling metrics query job - {}'.format(job['id']))
-            data = ctx.client.get('/email/{}/responses'.format(job['id']), endpoint='metrics')
-            if data != '':
-                break
-            else:
-                time.sleep(METRIC_JOB_POLL_SLEEP)
-
+        data = fetch_metric_job_result(ctx, job_id)
+        if data == '':
+            raise Exception('Metric job timeout ({} secs)'.format(
+                MAX_METRIC_JOB_TIME))
+        LOGGER.info('Metrics query job - {} - completed in {:.1f} secs'.format(
+            job_id,
+            time.monotonic() - start))
+
+    # a job with no responses returns a single empty id
     if len(data['contact_ids']) == 1 and data['contact_ids'][0] == '':
         return
 
-    data_rows = []
-    metric_date = start_date.isoformat()
-    for contact_id in data['contact_ids']:
-        data_rows.append({
-            'date': metric_date,
+    metric_date_time = datetime.combine(metric_date, datetime.min.time(), timezone.utc).isoformat()
+    data_rows = [
+        {
+            'date': metric_date_time,
             'metric': metric,
             'contact_id': contact_id,
             'campaign_id': campaign_id
-        })
+        }
+        for contact_id in data['contact_ids']
+    ]
+    if not data_rows:
+        return
 
     write_records('metrics', data_rows)
 
 def write_metrics_state(ctx, campaigns_to_resume, metrics_to_resume, date_to_resume):
     write_bookmark(ctx.state, 'metrics', 'campaigns_to_resume', campaigns_to_resume)
     write_bookmark(ctx.state, 'metrics', 'metrics_to_resume', metrics_to_resume)
-    write_bookmark(ctx.state, 'metrics', 'date_to_resume', date_to_resume.to_date_string())
-    ctx.write_state()
+    write_bookmark(ctx.state, 'metrics', 'date_to_resume', date_to_resume.isoformat())
+    # metric jobs may be writing records from worker threads
+    with WRITE_LOCK:
+        ctx.write_state()
+
+def write_completed_metrics_state(ctx, pending_jobs, max_pending):
+    # state is written in submission order, so a resume never skips a job that
+    # hasn't finished, waiting on the oldest job while too many are pending
+    while pending_jobs and \
+          (len(pending_jobs) > max_pending or pending_jobs[0][0].done()):
+        future, state_args = pending_jobs[0]
+        future.result()
+        pending_jobs.popleft()
+        write_metrics_state(ctx, *state_args)
 
 def sync_metrics(ctx, campaigns):
     max_pages = ctx.config.get('max_pages')
@@ -302,10 +400,10 @@ def sync_metrics(ctx, campaigns):
     else:
         metrics_selected = METRICS_AVAILABLE
 
-    start_date = pendulum.parse(ctx.config.get('start_date', 'now'))
-    end_date = pendulum.parse(ctx.config.get('end_date', 'now'))
+    start_date = parse_date(bookmark.get('last_metric_date') or ctx.config.get('start_date', 'now'))
+    end_date = parse_date(ctx.config.get('end_date', 'now'))
 
-    start_date = bookmark.get('last_metric_date', start_date)
+    all_campaign_ids = [campaign['id'] for campaign in campaigns if campaign['deleted'] is None]
 
     campaigns_to_resume = bookmark.get('campaigns_to_resume')
     if campaigns_to_resume:
@@ -313,43 +411,64 @@ def sync_metrics(ctx, campaigns):
         last_metrics = bookmark.get('metrics_to_resume')
         last_date = bookmark.get('date_to_resume')
         if last_date:
-            last_date = pendulum.parse(last_date)
+            last_date = parse_date(last_date)
     else:
-        campaign_ids = (
-            list(map(lambda x: x['id'],
-                     filter(lambda x: x['deleted'] is None,
-                            campaigns)))
-        )
-        metrics_to_resume = metrics_selected
+        campaign_ids = all_campaign_ids
         last_date = None
         last_metrics = None
 
+    # a campaign has no responses before it was created, so those days are skipped
+    campaign_created_dates = {}
+    for campaign in campaigns:
+        if campaign['created']:
+            campaign_created_dates[campaign['id']] = parse_date(campaign['created'])
+
     current_date = last_date or start_date
 
     if max_pages:
         end_date = current_date
         metrics_selected = metrics_selected[:max_pages]
 
-    while current_date <= end_date:
-        next_date = current_date.add(days=1)
-        campaigns_to_resume = campaign_ids.copy()
-        for campaign_id in campaign_ids:
-            campaign_metrics = last_metrics or metrics_selected
-            last_metrics = None
-            metrics_to_resume = campaign_metrics.copy()
-            for metric in campaign_metrics:
-                sync_metric(ctx,
-                            campaign_id,
-                            metric,
-                            current_date,
-                            next_date)
-                write_metrics_state(ctx, campaigns_to_resume, metrics_to_resume, current_date)
-                metrics_to_resume.remove(metric)
-            campaigns_to_resume.remove(campaign_id)
-        current_date = next_date
+    # the days are only built once instead of per campaign and metric
+    metric_dates = [current_date + timedelta(days=i)
+                    for i in range((end_date - current_date).days + 1)]
+
+    # jobs are submitted at the rate limit from here, while workers poll the
+    # submitted jobs and write their records
+    pending_jobs = deque()
+    try:
+        with ThreadPoolExecutor(max_workers=METRIC_JOB_WORKERS) as executor:
+            for current_date in metric_dates:
+                for campaign_index, campaign_id in enumerate(campaign_ids):
+                    campaign_metrics = last_metrics or metrics_selected
+                    last_metrics = None
+                    created_date = campaign_created_dates.get(campaign_id)
+                    if created_date and created_date > current_date:
+                        continue
+                    for metric_index, metric in enumerate(campaign_metrics):
+                        job_id = submit_metric_job(ctx, campaign_id, metric, current_date)
+                        future = executor.submit(sync_metric_job,
+                                                 ctx,
+                                                 campaign_id,
+                                                 metric,
+                                                 current_date,
+                                                 job_id)
+                        pending_jobs.append((future, (campaign_ids[campaign_index:],
+                                                      campaign_metrics[metric_index:],
+                                                      current_date)))
+                        write_completed_metrics_state(ctx, pending_jobs, METRIC_JOB_WORKERS)
+                # only the resumed day is limited to the campaigns left in the bookmark
+                campaign_ids = all_campaign_ids
+            write_completed_metrics_state(ctx, pending_jobs, 0)
+    finally:
+        # on failure the pool has waited for the running jobs, so keep the
+        # progress of those that succeeded up to the first one that didn't
+        while pending_jobs and pending_jobs[0][0].exception() is None:
+            _, state_args = pending_jobs.popleft()
+            write_metrics_state(ctx, *state_args)
 
     reset_stream(ctx.state, 'metrics')
-    write_bookmark(ctx.state, 'metrics', 'last_metric_date', end_date.to_date_string())
+    write_bookmark(ctx.state, 'metrics', 'last_metric_date', end_date.isoformat())
     ctx.write_state()
 
 def sync_selected_streams(ctx):